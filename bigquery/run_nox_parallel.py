@@ -0,0 +1,145 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run every interpreter variant of a nox session in parallel.
+
+Usage::
+
+    $ python run_nox_parallel.py unit
+    $ python run_nox_parallel.py unit -- -k test_client
+
+One ``nox -s <session>-<python>`` child process is started per Python
+version declared on the session in ``noxfile.py``. The children first
+install their dependencies one after another (the installs share the local
+packages' in-place builds and the pip cache), then run in parallel with the
+CPUs split between their ``pytest-xdist`` workers. The output of each child
+is written to ``.nox/logs/<session>-<python>.log``, and the script exits
+with a non-zero status if any of the children failed.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import subprocess
+import sys
+
+import nox
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(".nox", "logs")
+
+
+def _session_ids(session_name):
+    """Return the ``<session>-<python>`` IDs nox generates for a session."""
+    # Importing the noxfile registers its sessions with nox.
+    sys.path.insert(0, HERE)
+    import noxfile  # noqa: F401
+
+    registry = nox.registry.get()
+    if session_name not in registry:
+        raise SystemExit("Unknown nox session: {}".format(session_name))
+
+    # Sessions pinned to a single interpreter (or none) keep their plain name.
+    pythons = registry[session_name].python
+    if not pythons or isinstance(pythons, str):
+        return [session_name]
+    return ["{}-{}".format(session_name, python) for python in pythons]
+
+
+def _log_path(session_id):
+    return os.path.join(LOG_DIR, session_id + ".log")
+
+
+def _run_nox(session_id, nox_args, posargs, env=None):
+    """Run a single nox session, appending its output to the session's log."""
+    args = [sys.executable, "-m", "nox", "-s", session_id]
+    args.extend(nox_args)
+    if posargs:
+        args.append("--")
+        args.extend(posargs)
+
+    with open(_log_path(session_id), "a") as log_file:
+        return subprocess.call(args, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+
+
+def _report(session_id, returncode):
+    status = "succeeded" if returncode == 0 else "failed"
+    print("{}: {} (log: {})".format(session_id, status, _log_path(session_id)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("session", help="Name of the nox session, e.g. 'unit'.")
+    parser.add_argument(
+        "posargs", nargs="*", help="Extra arguments passed through to the session."
+    )
+    args = parser.parse_args()
+
+    os.chdir(HERE)
+    session_ids = _session_ids(args.session)
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    for session_id in session_ids:
+        open(_log_path(session_id), "w").close()
+
+    # Concurrent installs would rebuild the same ``*.egg-info`` directories
+    # of the in-place local packages and write to the same pip cache at the
+    # same time, so install everything sequentially first.
+    failed = []
+    installed = []
+    for session_id in session_ids:
+        returncode = _run_nox(session_id, ["--install-only"], args.posargs)
+        if returncode == 0:
+            installed.append(session_id)
+        else:
+            _report(session_id, returncode)
+            failed.append(session_id)
+
+    # Split the CPUs between the children's pytest-xdist workers rather than
+    # letting each of them start one worker per CPU.
+    env = dict(os.environ)
+    if installed:
+        workers = max(1, (os.cpu_count() or 1) // len(installed))
+        env.setdefault("NOX_PYTEST_WORKERS", str(workers))
+
+    # Each worker only waits on a child process, so threads are sufficient.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, len(installed))
+    ) as pool:
+        futures = {
+            pool.submit(
+                _run_nox,
+                session_id,
+                ["--reuse-existing-virtualenvs", "--no-install"],
+                args.posargs,
+                env,
+            ): session_id
+            for session_id in installed
+        }
+        for future in concurrent.futures.as_completed(futures):
+            session_id = futures[future]
+            returncode = future.result()
+            _report(session_id, returncode)
+            if returncode != 0:
+                failed.append(session_id)
+
+    if failed:
+        print("Failed sessions: {}".format(", ".join(sorted(failed))))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
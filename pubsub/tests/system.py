@@ -14,8 +14,8 @@
 
 from __future__ import absolute_import
 
-import datetime
-import itertools
+import array
+import concurrent.futures
 import operator as op
 import os
 import threading
@@ -25,16 +25,77 @@ import mock
 import pytest
 import six
 
+from google.api_core.exceptions import NotFound
 import google.auth
 from google.cloud import pubsub_v1
 from google.cloud.pubsub_v1 import exceptions
-from google.cloud.pubsub_v1 import futures
 from google.cloud.pubsub_v1 import types
+from google.iam.v1 import policy_pb2
 
 
 from test_utils.system import unique_resource_id
 
 
+# Each message should be smaller than 10**7 bytes (the server side limit for
+# PublishRequest), but all messages combined in a PublishRequest should
+# slightly exceed that threshold to make sure the publish code handles these
+# cases well.
+# Mind that the total PublishRequest size must still be smaller than
+# 10 * 1024 * 1024 bytes in order to not exceed the max request body size limit.
+LARGE_MESSAGE_DATA = b"x" * (2 * 10 ** 6)
+
+LARGE_MESSAGES_BATCH_SETTINGS = types.BatchSettings(
+    max_bytes=11 * 1000 * 1000,  # more than the server limit of 10 ** 7
+    max_latency=2.0,  # so that autocommit happens after publishing all messages
+    max_messages=100,
+)
+
+PUBLISH_MESSAGES_COUNT = 500
+
+# Allow all messages of ``test_publish_messages`` to go out in a single
+# publish request. A batch only accepts a message if that keeps its message
+# count below ``max_messages``, hence the limit is one more than the count.
+SINGLE_REQUEST_BATCH_SETTINGS = types.BatchSettings(
+    max_messages=PUBLISH_MESSAGES_COUNT + 1, max_latency=0.05
+)
+
+# Bindings added to topic and subscription policies by the IAM tests.
+# ``extend()`` copies them into the policy, so the same messages can be reused.
+IAM_POLICY_BINDINGS = (
+    policy_pb2.Binding(role="roles/pubsub.editor", members=["domain:google.com"]),
+    policy_pb2.Binding(
+        role="roles/pubsub.viewer", members=["group:cloud-logs@google.com"]
+    ),
+)
+
+# Sort / projection keys for the listing and IAM tests.
+_BY_NAME = op.attrgetter("name")
+_BY_ROLE = op.attrgetter("role")
+
+FLOW_CONTROL_MAX_1 = types.FlowControl(max_messages=1)
+FLOW_CONTROL_MAX_5 = types.FlowControl(max_messages=5)
+
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:  # Python < 3.7
+
+    def _monotonic_ns():
+        return int(time.time() * 10 ** 9)
+
+
+# Message payloads built by ``_messages_for()``, keyed by message count.
+_MESSAGES_CACHE = {}
+
+
+def _messages_for(count):
+    """Return ``count`` numbered message payloads, reused across calls."""
+    messages = _MESSAGES_CACHE.get(count)
+    if messages is None:
+        messages = tuple(b"message %d/%d" % (i, count) for i in range(1, count + 1))
+        _MESSAGES_CACHE[count] = messages
+    return messages
+
+
 @pytest.fixture(scope=u"module")
 def project():
     _, default_project = google.auth.default()
@@ -51,6 +112,17 @@ def subscriber():
     yield pubsub_v1.SubscriberClient()
 
 
+@pytest.fixture(scope=u"module")
+def shared_topic_path(project, publisher):
+    # A topic for the tests that do not need one of their own, i.e. those
+    # that only publish to it (nothing subscribes) or manage its IAM policy.
+    topic_name = "t" + unique_resource_id("-")
+    topic_path = publisher.topic_path(project, topic_name)
+    publisher.create_topic(topic_path)
+    yield topic_path
+    publisher.delete_topic(topic_path)
+
+
 @pytest.fixture
 def topic_path(project, publisher):
     topic_name = "t" + unique_resource_id("-")
@@ -68,49 +140,57 @@ def cleanup():
     registry = []
     yield registry
 
-    # Perform all clean up.
-    for to_call, argument in registry:
+    # Perform all clean up. The calls are independent API requests, so issue
+    # them concurrently.
+    if registry:
+        max_workers = min(8, len(registry))
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(_call_ignoring_not_found, registry))
+
+
+def _call_ignoring_not_found(cleanup_item):
+    to_call, argument = cleanup_item
+    try:
         to_call(argument)
+    except NotFound:
+        # The resource was never created, or is already gone.
+        pass
 
 
-def test_publish_messages(publisher, topic_path, cleanup):
-    # Make sure the topic gets deleted.
-    cleanup.append((publisher.delete_topic, topic_path))
+def _call_concurrently(func, args_list):
+    """Call ``func(*args)`` for each ``args`` in ``args_list`` concurrently.
 
-    publisher.create_topic(topic_path)
+    Each call is expected to be an independent API request. Returns the
+    results in the order of ``args_list``.
+    """
+    max_workers = min(8, len(args_list))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(lambda args: func(*args), args_list))
 
-    futures = [
-        publisher.publish(
-            topic_path, b"The hail in Wales falls mainly on the snails.", num=str(i)
-        )
-        for i in six.moves.range(500)
-    ]
+
+def test_publish_messages(publisher, shared_topic_path):
+    topic_path = shared_topic_path
+
+    publish = publisher.publish
+    data = b"The hail in Wales falls mainly on the snails."
+    with mock.patch.object(publisher, "batch_settings", SINGLE_REQUEST_BATCH_SETTINGS):
+        futures = [
+            publish(topic_path, data, num=str(i)) for i in range(PUBLISH_MESSAGES_COUNT)
+        ]
 
     for future in futures:
         result = future.result()
         assert isinstance(result, six.string_types)
 
 
-def test_publish_large_messages(publisher, topic_path, cleanup):
-    # Make sure the topic gets deleted.
-    cleanup.append((publisher.delete_topic, topic_path))
-
-    # Each message should be smaller than 10**7 bytes (the server side limit for
-    # PublishRequest), but all messages combined in a PublishRequest should
-    # slightly exceed that threshold to make sure the publish code handles these
-    # cases well.
-    # Mind that the total PublishRequest size must still be smaller than
-    # 10 * 1024 * 1024 bytes in order to not exceed the max request body size limit.
-    msg_data = b"x" * (2 * 10 ** 6)
-
-    publisher.batch_settings = types.BatchSettings(
-        max_bytes=11 * 1000 * 1000,  # more than the server limit of 10 ** 7
-        max_latency=2.0,  # so that autocommit happens after publishing all messages
-        max_messages=100,
-    )
-    publisher.create_topic(topic_path)
+def test_publish_large_messages(publisher, shared_topic_path):
+    topic_path = shared_topic_path
 
-    futures = [publisher.publish(topic_path, msg_data, num=str(i)) for i in range(5)]
+    with mock.patch.object(publisher, "batch_settings", LARGE_MESSAGES_BATCH_SETTINGS):
+        futures = [
+            publisher.publish(topic_path, LARGE_MESSAGE_DATA, num=str(i))
+            for i in range(5)
+        ]
 
     # If the publishing logic correctly split all messages into more than a
     # single batch despite a high BatchSettings.max_bytes limit, there should
@@ -137,7 +217,7 @@ def test_subscribe_to_messages(
     # Publish some messages.
     futures = [
         publisher.publish(topic_path, b"Wooooo! The claaaaaw!", num=str(index))
-        for index in six.moves.range(50)
+        for index in range(50)
     ]
 
     # Make sure the publish completes.
@@ -147,20 +227,14 @@ def test_subscribe_to_messages(
     # Actually open the subscription and hold it open for a few seconds.
     # The callback should process the message numbers to prove
     # that we got everything at least once.
-    callback = AckCallback()
+    callback = AckCallback(target=50)
     future = subscriber.subscribe(subscription_path, callback)
-    for second in six.moves.range(10):
-        time.sleep(1)
-
-        # The callback should have fired at least fifty times, but it
-        # may take some time.
-        if callback.calls >= 50:
-            return
-
-    # Okay, we took too long; fail out.
-    assert callback.calls >= 50
-
-    future.cancel()
+    try:
+        # The callback should fire at least fifty times, but it may take
+        # some time; fail out if it takes too long.
+        assert callback.done_event.wait(timeout=10)
+    finally:
+        future.cancel()
 
 
 def test_subscribe_to_messages_async_callbacks(
@@ -180,7 +254,7 @@ def test_subscribe_to_messages_async_callbacks(
     # Publish some messages.
     futures = [
         publisher.publish(topic_path, b"Wooooo! The claaaaaw!", num=str(index))
-        for index in six.moves.range(2)
+        for index in range(2)
     ]
 
     # Make sure the publish completes.
@@ -189,28 +263,22 @@ def test_subscribe_to_messages_async_callbacks(
 
     # We want to make sure that the callback was called asynchronously. So
     # track when each call happened and make sure below.
-    callback = TimesCallback(2)
+    callback = TimesCallback(2, target=2)
 
     # Actually open the subscription and hold it open for a few seconds.
     future = subscriber.subscribe(subscription_path, callback)
-    for second in six.moves.range(5):
-        time.sleep(4)
+    try:
+        # The callback should fire at least two times, but it may take
+        # some time; fail out if it takes too long.
+        assert callback.done_event.wait(timeout=20)
 
-        # The callback should have fired at least two times, but it may
-        # take some time.
-        if callback.calls >= 2:
-            first, last = sorted(callback.call_times[:2])
-            diff = last - first
-            # "Ensure" the first two callbacks were executed asynchronously
-            # (sequentially would have resulted in a difference of 2+
-            # seconds).
-            assert diff.days == 0
-            assert diff.seconds < callback.sleep_time
-
-    # Okay, we took too long; fail out.
-    assert callback.calls >= 2
-
-    future.cancel()
+        first_ns, last_ns = sorted(callback.call_times_ns[:2])
+        # "Ensure" the first two callbacks were executed asynchronously
+        # (sequentially would have resulted in a difference of 2+
+        # seconds).
+        assert last_ns - first_ns < callback.sleep_time * 10 ** 9
+    finally:
+        future.cancel()
 
 
 def test_creating_subscriptions_with_non_default_settings(
@@ -254,13 +322,12 @@ def test_listing_project_topics(publisher, project, cleanup):
         publisher.topic_path(project, "topic-{}".format(i) + unique_resource_id("."))
         for i in range(1, 4)
     ]
-    for topic in topic_paths:
-        cleanup.append((publisher.delete_topic, topic))
-        publisher.create_topic(topic)
+    cleanup.extend((publisher.delete_topic, topic) for topic in topic_paths)
+    _call_concurrently(publisher.create_topic, [(topic,) for topic in topic_paths])
 
     project_path = publisher.project_path(project)
     project_topics = publisher.list_topics(project_path)
-    project_topics = set(t.name for t in project_topics)
+    project_topics = frozenset(map(_BY_NAME, project_topics))
 
     # there might be other topics in the project, thus do a "is subset" check
     assert set(topic_paths) <= project_topics
@@ -272,9 +339,8 @@ def test_listing_project_subscriptions(publisher, subscriber, project, cleanup):
         publisher.topic_path(project, "topic-1" + unique_resource_id(".")),
         publisher.topic_path(project, "topic-2" + unique_resource_id(".")),
     ]
-    for topic in topic_paths:
-        cleanup.append((publisher.delete_topic, topic))
-        publisher.create_topic(topic)
+    cleanup.extend((publisher.delete_topic, topic) for topic in topic_paths)
+    _call_concurrently(publisher.create_topic, [(topic,) for topic in topic_paths])
 
     # create subscriptions
     subscription_paths = [
@@ -283,15 +349,22 @@ def test_listing_project_subscriptions(publisher, subscriber, project, cleanup):
         )
         for i in range(1, 4)
     ]
-    for i, subscription in enumerate(subscription_paths):
-        topic = topic_paths[i % 2]
-        cleanup.append((subscriber.delete_subscription, subscription))
-        subscriber.create_subscription(subscription, topic)
+    cleanup.extend(
+        (subscriber.delete_subscription, subscription)
+        for subscription in subscription_paths
+    )
+    _call_concurrently(
+        subscriber.create_subscription,
+        [
+            (subscription, topic_paths[i % 2])
+            for i, subscription in enumerate(subscription_paths)
+        ],
+    )
 
     # retrieve subscriptions and check that the list matches the expected
     project_path = subscriber.project_path(project)
     subscriptions = subscriber.list_subscriptions(project_path)
-    subscriptions = set(s.name for s in subscriptions)
+    subscriptions = frozenset(map(_BY_NAME, subscriptions))
 
     # there might be other subscriptions in the project, thus do a "is subset" check
     assert set(subscription_paths) <= subscriptions
@@ -303,9 +376,8 @@ def test_listing_topic_subscriptions(publisher, subscriber, project, cleanup):
         publisher.topic_path(project, "topic-1" + unique_resource_id(".")),
         publisher.topic_path(project, "topic-2" + unique_resource_id(".")),
     ]
-    for topic in topic_paths:
-        cleanup.append((publisher.delete_topic, topic))
-        publisher.create_topic(topic)
+    cleanup.extend((publisher.delete_topic, topic) for topic in topic_paths)
+    _call_concurrently(publisher.create_topic, [(topic,) for topic in topic_paths])
 
     # create subscriptions
     subscription_paths = [
@@ -314,10 +386,17 @@ def test_listing_topic_subscriptions(publisher, subscriber, project, cleanup):
         )
         for i in range(1, 4)
     ]
-    for i, subscription in enumerate(subscription_paths):
-        topic = topic_paths[i % 2]
-        cleanup.append((subscriber.delete_subscription, subscription))
-        subscriber.create_subscription(subscription, topic)
+    cleanup.extend(
+        (subscriber.delete_subscription, subscription)
+        for subscription in subscription_paths
+    )
+    _call_concurrently(
+        subscriber.create_subscription,
+        [
+            (subscription, topic_paths[i % 2])
+            for i, subscription in enumerate(subscription_paths)
+        ],
+    )
 
     # retrieve subscriptions and check that the list matches the expected
     subscriptions = publisher.list_topic_subscriptions(topic_paths[0])
@@ -326,17 +405,13 @@ def test_listing_topic_subscriptions(publisher, subscriber, project, cleanup):
     assert subscriptions == {subscription_paths[0], subscription_paths[2]}
 
 
-def test_managing_topic_iam_policy(publisher, topic_path, cleanup):
-    cleanup.append((publisher.delete_topic, topic_path))
+def test_managing_topic_iam_policy(publisher, shared_topic_path):
+    topic_path = shared_topic_path
 
-    # create a topic and customize its policy
-    publisher.create_topic(topic_path)
+    # customize the topic's policy
     topic_policy = publisher.get_iam_policy(topic_path)
 
-    topic_policy.bindings.add(role="roles/pubsub.editor", members=["domain:google.com"])
-    topic_policy.bindings.add(
-        role="roles/pubsub.viewer", members=["group:cloud-logs@google.com"]
-    )
+    topic_policy.bindings.extend(IAM_POLICY_BINDINGS)
     new_policy = publisher.set_iam_policy(topic_path, topic_policy)
 
     # fetch the topic policy again and check its values
@@ -344,7 +419,7 @@ def test_managing_topic_iam_policy(publisher, topic_path, cleanup):
     assert topic_policy.bindings == new_policy.bindings
     assert len(topic_policy.bindings) == 2
 
-    bindings = sorted(topic_policy.bindings, key=op.attrgetter("role"))
+    bindings = sorted(topic_policy.bindings, key=_BY_ROLE)
     assert bindings[0].role == "roles/pubsub.editor"
     assert bindings[0].members == ["domain:google.com"]
 
@@ -364,10 +439,7 @@ def test_managing_subscription_iam_policy(
     subscriber.create_subscription(subscription_path, topic_path)
     sub_policy = subscriber.get_iam_policy(subscription_path)
 
-    sub_policy.bindings.add(role="roles/pubsub.editor", members=["domain:google.com"])
-    sub_policy.bindings.add(
-        role="roles/pubsub.viewer", members=["group:cloud-logs@google.com"]
-    )
+    sub_policy.bindings.extend(IAM_POLICY_BINDINGS)
     new_policy = subscriber.set_iam_policy(subscription_path, sub_policy)
 
     # fetch the subscription policy again and check its values
@@ -375,7 +447,7 @@ def test_managing_subscription_iam_policy(
     assert sub_policy.bindings == new_policy.bindings
     assert len(sub_policy.bindings) == 2
 
-    bindings = sorted(sub_policy.bindings, key=op.attrgetter("role"))
+    bindings = sorted(sub_policy.bindings, key=_BY_ROLE)
     assert bindings[0].role == "roles/pubsub.editor"
     assert bindings[0].members == ["domain:google.com"]
 
@@ -404,7 +476,9 @@ class TestStreamingPull(object):
         class CallbackError(Exception):
             pass
 
-        callback = mock.Mock(side_effect=CallbackError)
+        def callback(message):
+            raise CallbackError()
+
         future = subscriber.subscribe(subscription_path, callback)
 
         with pytest.raises(CallbackError):
@@ -435,9 +509,8 @@ class TestStreamingPull(object):
             processing_time=13,  # more than the default stream ACK deadline (10s)
             resolve_at_msg_count=3,  # one more than the published messages count
         )
-        flow_control = types.FlowControl(max_messages=1)
         subscription_future = subscriber.subscribe(
-            subscription_path, callback, flow_control=flow_control
+            subscription_path, callback, flow_control=FLOW_CONTROL_MAX_1
         )
 
         # We expect to process the first two messages in 2 * 13 seconds, and
@@ -446,7 +519,8 @@ class TestStreamingPull(object):
         # no duplicates in 60 seconds, we can reasonably assume that there
         # won't be any.
         try:
-            callback.done_future.result(timeout=60)
+            if not callback.done_event.wait(timeout=60):
+                raise exceptions.TimeoutError()
         except exceptions.TimeoutError:
             # future timed out, because we received no excessive messages
             assert sorted(callback.seen_message_ids) == [1, 2]
@@ -475,7 +549,7 @@ class TestStreamingPull(object):
 
         # now subscribe and do the main part, check for max pending messages
         total_messages = sum(batch_sizes)
-        flow_control = types.FlowControl(max_messages=5)
+        flow_control = FLOW_CONTROL_MAX_5
         callback = StreamingPullCallback(
             processing_time=1, resolve_at_msg_count=total_messages
         )
@@ -491,13 +565,14 @@ class TestStreamingPull(object):
         # 10 seconds (+ overhead), thus a full minute should be more than enough
         # for the processing to complete. If not, fail the test with a timeout.
         try:
-            callback.done_future.result(timeout=60)
+            if not callback.done_event.wait(timeout=60):
+                raise exceptions.TimeoutError()
         except exceptions.TimeoutError:
             pytest.fail(
                 "Timeout: receiving/processing streamed messages took too long."
             )
 
-        # The callback future gets resolved once total_messages have been processed,
+        # The callback event gets set once total_messages have been processed,
         # but we want to wait for just a little bit longer to possibly catch cases
         # when the callback gets invoked *more* than total_messages times.
         time.sleep(3)
@@ -505,10 +580,10 @@ class TestStreamingPull(object):
         try:
             # All messages should have been processed exactly once, and no more
             # than max_messages simultaneously at any time.
+            # Bits 1..total_messages set, i.e. every seq_num seen.
+            expected_mask = ((1 << (total_messages + 1)) - 1) ^ 1
             assert callback.completed_calls == total_messages
-            assert sorted(callback.seen_message_ids) == list(
-                range(1, total_messages + 1)
-            )
+            assert callback.seen_mask == expected_mask
             assert callback.max_pending_ack <= flow_control.max_messages
         finally:
             subscription_future.cancel()  # trigger clean shutdown
@@ -542,7 +617,8 @@ class TestStreamingPull(object):
         self._publish_messages(publisher, topic_path, batch_sizes=[1])
 
         try:
-            callback.done_future.result(timeout=10)
+            if not callback.done_event.wait(timeout=10):
+                raise exceptions.TimeoutError()
         except exceptions.TimeoutError:
             pytest.fail(
                 "Timeout: receiving/processing streamed messages took too long."
@@ -553,60 +629,72 @@ class TestStreamingPull(object):
             future.cancel()
 
     def _publish_messages(self, publisher, topic_path, batch_sizes):
-        """Publish ``count`` messages in batches and wait until completion."""
-        publish_futures = []
-        msg_counter = itertools.count(start=1)
+        """Publish messages in batches of ``batch_sizes`` and wait until completion.
+
+        Each batch is published before the next one is started, so that every
+        batch goes out in its own publish request(s).
+        """
+        publish = publisher.publish
+        seq_nums = iter(map(str, range(1, sum(batch_sizes) + 1)))
 
         for batch_size in batch_sizes:
             msg_batch = self._make_messages(count=batch_size)
-            for msg in msg_batch:
-                future = publisher.publish(
-                    topic_path, msg, seq_num=str(next(msg_counter))
-                )
-                publish_futures.append(future)
-            time.sleep(0.1)
+            publish_futures = [
+                publish(topic_path, msg, seq_num=next(seq_nums)) for msg in msg_batch
+            ]
 
-        # wait untill all messages have been successfully published
-        for future in publish_futures:
-            future.result(timeout=30)
+            # Waiting for the batch to be published, rather than sleeping for a
+            # fixed time, keeps the client from merging it with the next one.
+            for future in publish_futures:
+                future.result(timeout=30)
 
     def _make_messages(self, count):
-        messages = [
-            u"message {}/{}".format(i, count).encode("utf-8")
-            for i in range(1, count + 1)
-        ]
-        return messages
+        return _messages_for(count)
 
 
 class AckCallback(object):
-    def __init__(self):
-        self.calls = 0
-        self.lock = threading.Lock()
+    """Ack each message and set ``done_event`` after ``target`` calls.
+
+    A call is only counted **after** it has finished, by appending to a list.
+    ``list.append()`` is atomic, so no lock is needed.
+    """
+
+    def __init__(self, target):
+        self.acked_message_ids = []
+        self._target = target
+        self.done_event = threading.Event()
+
+    @property
+    def calls(self):
+        return len(self.acked_message_ids)
 
     def __call__(self, message):
         message.ack()
-        # Only increment the number of calls **after** finishing.
-        with self.lock:
-            self.calls += 1
+        self.acked_message_ids.append(message.message_id)
+        if self.calls >= self._target:
+            self.done_event.set()
 
 
 class TimesCallback(object):
-    def __init__(self, sleep_time):
+    """Like :class:`AckCallback`, but sleeps first and records call start times."""
+
+    def __init__(self, sleep_time, target):
         self.sleep_time = sleep_time
-        self.calls = 0
-        self.call_times = []
-        self.lock = threading.Lock()
+        self.call_times_ns = []
+        self._target = target
+        self.done_event = threading.Event()
+
+    @property
+    def calls(self):
+        return len(self.call_times_ns)
 
     def __call__(self, message):
-        now = datetime.datetime.now()
+        now_ns = _monotonic_ns()
         time.sleep(self.sleep_time)
         message.ack()
-        # Only increment the number of calls **after** finishing.
-        with self.lock:
-            # list.append() is thread-safe, but we still wait until
-            # ``calls`` is incremented to do it.
-            self.call_times.append(now)
-            self.calls += 1
+        self.call_times_ns.append(now_ns)
+        if self.calls >= self._target:
+            self.done_event.set()
 
 
 class StreamingPullCallback(object):
@@ -616,16 +704,22 @@ class StreamingPullCallback(object):
         self._pending_ack = 0
         self.max_pending_ack = 0
         self.completed_calls = 0
-        self.seen_message_ids = []
+        self.seen_message_ids = array.array("i")
+        # Bit N is set once the message with seq_num N has been seen.
+        self.seen_mask = 0
 
         self._resolve_at_msg_count = resolve_at_msg_count
-        self.done_future = futures.Future()
+        self.done_event = threading.Event()
 
     def __call__(self, message):
+        seq_num = int(message.attributes["seq_num"])
+        # array.append is atomic, so it does not need to hold the lock.
+        self.seen_message_ids.append(seq_num)
+
         with self._lock:
             self._pending_ack += 1
             self.max_pending_ack = max(self.max_pending_ack, self._pending_ack)
-            self.seen_message_ids.append(int(message.attributes["seq_num"]))
+            self.seen_mask |= 1 << seq_num
 
         time.sleep(self._processing_time)
 
@@ -635,5 +729,4 @@ class StreamingPullCallback(object):
             self.completed_calls += 1
 
             if self.completed_calls >= self._resolve_at_msg_count:
-                if not self.done_future.done():
-                    self.done_future.set_result(None)
+                self.done_event.set()